@@ -1,38 +1,126 @@
 #!/usr/bin/env python
+import argparse
+import csv
 import datetime
+import io
+import logging
+import operator
 import os
-import sys
-from functools import partial
-from typing import Any, Dict, List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
 
+import orjson
 import psycopg2
 import requests
 from dotenv import load_dotenv
 from psycopg2 import sql
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 load_dotenv()
 
 #DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
 
 TRIES = 10
+# seconds between attempts to save to the database
+RETRY_DELAY = 5
+# connect and read timeouts of the API requests, in seconds
+TIMEOUT = (10, 120)
+
+COLUMNS = (
+    "date",
+    "spent",
+    "impressions",
+    "goals",
+    "price_target",
+    "cpm",
+    "object",
+    "account_name",
+    "clicks",
+    "cpc",
+    "ctr",
+)
+# picks the column values of a record in COLUMNS order
+row_values = operator.itemgetter(*COLUMNS)
+
+# the table names are constants, so the queries of the load are rendered once
+TABLE_NAME = "statistics"
+STAGING_TABLE_NAME = f"stg_{TABLE_NAME}"
+_columns = ", ".join(COLUMNS)
+
+CREATE_STAGING_QUERY = f"""
+    CREATE TEMP TABLE {STAGING_TABLE_NAME} ON COMMIT DROP AS
+    SELECT {_columns} FROM {TABLE_NAME} WITH NO DATA;
+"""
+
+# NULL marker of the COPY data, unlike an empty field it keeps '' apart
+COPY_NULL = "\\N"
+COPY_QUERY = (
+    f"COPY {STAGING_TABLE_NAME} ({_columns}) "
+    f"FROM STDIN WITH (FORMAT CSV, NULL '{COPY_NULL}');"
+)
+
+# upsert the report and delete rows of the same dates that are no longer
+# in it; both parts see the table as it was before the statement
+MERGE_QUERY = f"""
+    WITH upserted AS (
+        INSERT INTO {TABLE_NAME} ({_columns})
+        SELECT {_columns} FROM {STAGING_TABLE_NAME}
+        ON CONFLICT (date, object, account_name) DO UPDATE SET
+            spent = EXCLUDED.spent,
+            impressions = EXCLUDED.impressions,
+            goals = EXCLUDED.goals,
+            price_target = EXCLUDED.price_target,
+            cpm = EXCLUDED.cpm,
+            account_name = EXCLUDED.account_name,
+            clicks = EXCLUDED.clicks,
+            cpc = EXCLUDED.cpc,
+            ctr = EXCLUDED.ctr
+        -- leave unchanged rows alone instead of writing identical versions
+        WHERE (
+            {TABLE_NAME}.spent, {TABLE_NAME}.impressions, {TABLE_NAME}.goals,
+            {TABLE_NAME}.price_target, {TABLE_NAME}.cpm, {TABLE_NAME}.clicks,
+            {TABLE_NAME}.cpc, {TABLE_NAME}.ctr
+        ) IS DISTINCT FROM (
+            EXCLUDED.spent, EXCLUDED.impressions, EXCLUDED.goals,
+            EXCLUDED.price_target, EXCLUDED.cpm, EXCLUDED.clicks,
+            EXCLUDED.cpc, EXCLUDED.ctr
+        )
+    )
+    DELETE FROM {TABLE_NAME} t
+    WHERE t.date IN (SELECT DISTINCT date FROM {STAGING_TABLE_NAME})
+        AND NOT EXISTS (
+            -- NULL keys never match, as in the unique constraint: such rows
+            -- are inserted anew, so their previous copies must go
+            SELECT 1 FROM {STAGING_TABLE_NAME} s
+            WHERE s.date = t.date
+                AND s.object = t.object
+                AND s.account_name = t.account_name
+        );
+"""
 
 CSI = "\033["
-COLORS = {
-    "red": 91,
-    "green": 92,
-    "yellow": 93,
-    "blue": 94,
-    "magenta": 95,
-    "cyan": 96,
-    "white": 97,
+RESET = f"{CSI}0m"
+COLOR_PREFIXES = {
+    level: f"{CSI}{code}m"
+    for level, code in {
+        logging.DEBUG: 96,  # cyan
+        logging.INFO: 92,  # green
+        logging.WARNING: 93,  # yellow
+        logging.ERROR: 91,  # red
+        logging.CRITICAL: 95,  # magenta
+    }.items()
 }
 
+logger = logging.getLogger(__name__)
 
-def colored(color: str, text: str, **kwargs) -> None:
-    print_err(f"{CSI}{COLORS.get(color.lower(), '')}m{text}{CSI}m", **kwargs)
 
-
-print_err = partial(print, file=sys.stderr)
+class ColorFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        prefix = COLOR_PREFIXES.get(record.levelno)
+        return f"{prefix}{message}{RESET}" if prefix else message
 
 
 def create_database(db_config: Dict[str, Any]) -> None:
@@ -57,9 +145,9 @@ def create_database(db_config: Dict[str, Any]) -> None:
         cursor.execute(
             sql.SQL("CREATE DATABASE {}").format(sql.Identifier(db_name))
         )
-        colored("green", f"Database {db_name} created.")
+        logger.info("Database %s created.", db_name)
     else:
-        colored("yellow", f"Database {db_name} already exists.")
+        logger.debug("Database %s already exists.", db_name)
 
     cursor.close()
     connection.close()
@@ -69,7 +157,7 @@ def create_table(cursor: psycopg2.extensions.cursor, table_name: str) -> None:
     cursor.execute(
         sql.SQL("""
         CREATE TABLE IF NOT EXISTS {} (
-            id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+            id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
             date DATE,
             spent REAL,
             impressions REAL,
@@ -82,7 +170,7 @@ def create_table(cursor: psycopg2.extensions.cursor, table_name: str) -> None:
             cpc REAL,
             ctr REAL,
             UNIQUE (date, object, account_name)
-        );
+        ) WITH (fillfactor = 90);
     """).format(sql.Identifier(table_name))
     )
     cursor.execute(
@@ -100,41 +188,66 @@ def create_table(cursor: psycopg2.extensions.cursor, table_name: str) -> None:
             "CREATE INDEX IF NOT EXISTS idx_account_name ON {} (account_name);"
         ).format(sql.Identifier(table_name))
     )
-    colored("green", f"Table {table_name} created.")
+    logger.info("Table %s created.", table_name)
+
+
+def migrate_id_column(cursor: psycopg2.extensions.cursor, table_name: str) -> None:
+    cursor.execute(
+        """
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema()
+            AND table_name = %s AND column_name = 'id';
+        """,
+        (table_name,),
+    )
+    row = cursor.fetchone()
+    if not row or row[0] != "uuid":
+        return
+    # nothing references the ids, so the column is simply recreated
+    cursor.execute(
+        sql.SQL("""
+            ALTER TABLE {table} DROP COLUMN id;
+            ALTER TABLE {table} ADD COLUMN id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY;
+        """).format(table=sql.Identifier(table_name))
+    )
+    logger.info("Table %s switched to identity ids.", table_name)
+
+
+def copy_row(record: Dict[str, Any]) -> List[Any]:
+    return [COPY_NULL if value is None else value for value in row_values(record)]
 
 
 def save_statistics(
     cursor: psycopg2.extensions.cursor,
-    table_name: str,
     data: List[Dict[str, Any]],
-    batch_size: int = 1000,
 ) -> None:
-    for i in range(0, len(data), batch_size):
-        batch = data[i: i + batch_size]
-        cursor.executemany(
-            sql.SQL("""
-                INSERT INTO {} (
-                    date, spent, impressions, goals, price_target, cpm, object, account_name, clicks, cpc, ctr
-                ) VALUES (
-                    %(date)s, %(spent)s, %(impressions)s, %(goals)s, %(price_target)s, %(cpm)s, %(object)s, %(account_name)s, %(clicks)s, %(cpc)s, %(ctr)s
-                )
-                ON CONFLICT (date, object, account_name) DO UPDATE SET
-                    spent = EXCLUDED.spent,
-                    impressions = EXCLUDED.impressions,
-                    goals = EXCLUDED.goals,
-                    price_target = EXCLUDED.price_target,
-                    cpm = EXCLUDED.cpm,
-                    account_name = EXCLUDED.account_name,
-                    clicks = EXCLUDED.clicks,
-                    cpc = EXCLUDED.cpc,
-                    ctr = EXCLUDED.ctr;
-            """).format(sql.Identifier(table_name)),
-            batch
-        )
-        colored(
-            "green",
-            f"Saved {len(batch)} records from index {i} to {i + len(batch)}.",
-        )
+    # ON CONFLICT DO UPDATE fails if a key occurs twice in one statement, so
+    # keep only the last record for each key; keys with NULLs never conflict
+    # and such records are all kept
+    unique = {}
+    rest = []
+    for record in data:
+        key = record["date"], record["object"], record["account_name"]
+        if None in key:
+            rest.append(record)
+        else:
+            unique[key] = record
+    data = [*unique.values(), *rest]
+
+    # COPY into a staging table and merge it with a single upsert
+    cursor.execute(CREATE_STAGING_QUERY)
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerows(map(copy_row, data))
+    buf.seek(0)
+    cursor.copy_expert(COPY_QUERY, buf)
+
+    cursor.execute(MERGE_QUERY)
+    deleted = cursor.rowcount
+    logger.info(
+        "Saved %d records, %d stale records deleted.", len(data), deleted
+    )
 
 
 def fetch_statistics(session: requests.Session, username: str, password: str) -> List[Dict[str, Any]]:
@@ -142,10 +255,18 @@ def fetch_statistics(session: requests.Session, username: str, password: str) ->
         "username": username,
         "password": password,
     }
-    r = session.post("https://client.adstat.pro/api/v2/login", login_data)
-    login_result = r.json()
-    #print_err(login_result)
+    # a long-running session still carries the token of the previous login
+    session.headers.pop("Authorization", None)
+    r = session.post(
+        "https://client.adstat.pro/api/v2/login",
+        login_data,
+        timeout=TIMEOUT,
+    )
+    r.raise_for_status()
+    login_result = orjson.loads(r.content)
+    #logger.debug(login_result)
     access_token = login_result["access_token"]
+    session.headers["Authorization"] = f"Bearer {access_token}"
 
     # previous hour
     dt = datetime.datetime.now(datetime.UTC) - datetime.timedelta(hours=1)
@@ -172,70 +293,222 @@ def fetch_statistics(session: requests.Session, username: str, password: str) ->
         "use_account_currency": False,
     }
 
-    print_err(f"{filters=}")
+    logger.debug("filters=%r", filters)
     r = session.post(
         "https://client.adstat.pro/api/report/tgview", 
         json=filters,
-        headers={"Authorization": f"Bearer {access_token}"})
-    return r.json().get("results", [])
-
+        timeout=TIMEOUT)
+    r.raise_for_status()
+    return orjson.loads(r.content).get("results", [])
+
+
+def table_exists(cursor: psycopg2.extensions.cursor, table_name: str) -> bool:
+    cursor.execute("SELECT to_regclass(%s);", (table_name,))
+    return cursor.fetchone()[0] is not None
+
+
+def connect(db_config: Dict[str, Any]) -> psycopg2.extensions.connection:
+    connection = psycopg2.connect(**db_config)
+    try:
+        # the schema is normally set up by --migrate
+        with connection, connection.cursor() as cursor:
+            if not table_exists(cursor, TABLE_NAME):
+                create_table(cursor, TABLE_NAME)
+    except BaseException:
+        connection.close()
+        raise
+    return connection
+
+
+def migrate(db_config: Dict[str, Any]) -> None:
+    create_database(db_config)
+
+    connection = psycopg2.connect(**db_config)
+    try:
+        with connection, connection.cursor() as cursor:
+            create_table(cursor, TABLE_NAME)
+            migrate_id_column(cursor, TABLE_NAME)
+            # for tables created without it, only new pages are affected
+            cursor.execute(
+                sql.SQL("ALTER TABLE {} SET (fillfactor = 90);").format(
+                    sql.Identifier(TABLE_NAME)
+                )
+            )
+    finally:
+        connection.close()
 
-def main() -> None:
-    db_config = {
-        "dbname": os.getenv("DB_NAME", "adstat_db"),
-        "user": os.getenv("DB_USER", "docker"),
-        "password": os.getenv("DB_PASSWORD", "secret"),
-        "host": os.getenv("DB_HOST", "postgres"),
-        "port": int(os.getenv("DB_PORT", 5432)),
-        "sslmode": os.getenv("DB_SSLMODE", "require"),
-    }
 
+def create_session() -> requests.Session:
     session = requests.session()
     session.headers.update({
         "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.36"
     })
 
-    username = os.getenv("ADSTAT_USERNAME")
-    password = os.getenv("ADSTAT_PASSWORD")
- 
+    # the login and the report share one pooled connection, failed requests
+    # are retried by urllib3 with backoff
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            max_retries=Retry(
+                total=TRIES,
+                backoff_factor=1,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["POST"],
+            )
+        ),
+    )
+    return session
+
 
-    for _ in range(TRIES):
+def fetch(session: requests.Session) -> List[Dict[str, Any]]:
+    try:
+        statistics = fetch_statistics(
+            session,
+            os.getenv("ADSTAT_USERNAME"),
+            os.getenv("ADSTAT_PASSWORD"),
+        )
+    except (
+        requests.RequestException,
+        orjson.JSONDecodeError,
+        # unexpected response shapes: no access_token, a non-object report
+        KeyError,
+        AttributeError,
+    ) as e:
+        logger.error("Failed to fetch statistics: %r", e)
+        return []
+
+    if not statistics:
+        logger.warning("No statistics to save.")
+    return statistics
+
+
+def save(
+    connection: Optional[psycopg2.extensions.connection],
+    db_config: Dict[str, Any],
+    statistics: List[Dict[str, Any]],
+) -> Optional[psycopg2.extensions.connection]:
+    # only the transaction is retried, the report is not fetched again
+    for attempt in range(1, TRIES + 1):
         try:
-            create_database(db_config)
-
-            connection = psycopg2.connect(**db_config)
-            connection.autocommit = True
-            cursor = connection.cursor()
-            table_name = "statistics"
-            create_table(cursor, table_name) 
-            
-            statistics = fetch_statistics(
-                session,
-                username,
-                password,
-            )
+            if connection is None or connection.closed:
+                connection = connect(db_config)
+            # the whole load is committed at once or rolled back
+            with connection, connection.cursor() as cursor:
+                save_statistics(cursor, statistics)
+            break
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            # lost connections and deadlocks, start over on a new connection
+            logger.warning("Attempt %d of %d failed: %s", attempt, TRIES, e)
+            if connection is not None:
+                connection.close()
+            if attempt < TRIES:
+                time.sleep(RETRY_DELAY)
+        except psycopg2.Error as e:
+            logger.error("Failed to save statistics: %s", e)
+            return connection
+    else:
+        logger.error("Failed to save statistics after %d attempts.", TRIES)
+        return connection
 
-            if not statistics:
-                continue
+    logger.info("Finished successfully!")
+    return connection
 
-            date = statistics[0]['date']
-            delete_query = sql.SQL("""
-                DELETE FROM {} WHERE date = %s;
-            """).format(sql.Identifier(table_name))
 
-            cursor.execute(delete_query, (date,))
-            colored("green", f"All statistics records deleted where {date=}")
+def run(db_config: Dict[str, Any]) -> None:
+    session = create_session()
 
-            save_statistics(cursor, table_name, statistics)
-            cursor.close()
+    # the report is fetched while the database connection is being set up
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        statistics_future = executor.submit(fetch, session)
+        try:
+            connection = connect(db_config)
+        except psycopg2.Error as e:
+            # save() keeps trying to connect
+            logger.warning("Failed to connect to the database: %s", e)
+            connection = None
+
+    try:
+        statistics = statistics_future.result()
+        if statistics:
+            connection = save(connection, db_config, statistics)
+    finally:
+        if connection is not None:
             connection.close()
-            colored("green", "Finished successfully!")
+
+
+def seconds_until_next_hour() -> float:
+    now = datetime.datetime.now()
+    next_hour = (now + datetime.timedelta(hours=1)).replace(
+        minute=0, second=0, microsecond=0
+    )
+    return (next_hour - now).total_seconds()
+
+
+def serve(db_config: Dict[str, Any]) -> None:
+    # Postgres may still be starting along with the container
+    while True:
+        try:
+            migrate(db_config)
             break
-        except Exception as e:
-            colored("red", f"An error has occurred: {e}")
+        except psycopg2.OperationalError as e:
+            logger.error("Failed to migrate the database: %s", e)
+            time.sleep(RETRY_DELAY)
+
+    # the HTTP session and the database connection are kept between imports,
+    # save() reconnects when the connection was lost while idle
+    session = create_session()
+    connection = None
+    try:
+        while True:
+            try:
+                statistics = fetch(session)
+                if statistics:
+                    connection = save(connection, db_config, statistics)
+            except Exception:
+                logger.exception("Import failed.")
+            time.sleep(seconds_until_next_hour())
+    finally:
+        if connection is not None:
+            connection.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Import statistics from adstat.pro.")
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="create the database and the table, then exit",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="keep running and import statistics at the start of every hour",
+    )
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(ColorFormatter())
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        handlers=[handler],
+    )
+
+    db_config = {
+        "dbname": os.getenv("DB_NAME", "adstat_db"),
+        "user": os.getenv("DB_USER", "docker"),
+        "password": os.getenv("DB_PASSWORD", "secret"),
+        "host": os.getenv("DB_HOST", "postgres"),
+        "port": int(os.getenv("DB_PORT", 5432)),
+        "sslmode": os.getenv("DB_SSLMODE", "require"),
+    }
 
+    if args.migrate:
+        migrate(db_config)
+    elif args.serve:
+        serve(db_config)
+    else:
+        run(db_config)
 
 
 if __name__ == "__main__":
     main()
-